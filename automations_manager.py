@@ -1,25 +1,100 @@
 import os
-import yaml
-import requests
+import re
 
 # Set up API Authentication (OAuth2)
 PREFECT_API_URL = os.getenv("PREFECT_API_URL")  # Set this to your Prefect API URL
 OAUTH_TOKEN = os.getenv("OAUTH_TOKEN")          # OAuth2 token for API access
-HEADERS = {
-    "Authorization": f"Bearer {OAUTH_TOKEN}",
-    "Content-Type": "application/json",
-}
+
+def configure_api(api_url: str = None, oauth_token: str = None):
+    """Override the API settings read from the environment."""
+    global PREFECT_API_URL, OAUTH_TOKEN
+    PREFECT_API_URL = api_url or PREFECT_API_URL
+    OAUTH_TOKEN = oauth_token or OAUTH_TOKEN
+
+def api_request(method: str, url: str, **kwargs):
+    """Send an authenticated request to the Prefect REST API (requests is only imported here)."""
+    import requests
+
+    headers = {
+        "Authorization": f"Bearer {OAUTH_TOKEN}",
+        "Content-Type": "application/json",
+    }
+    return requests.request(method, url, headers=headers, **kwargs)
 
 def load_automation_file(filepath: str) -> dict:
     """Load automations.yaml from the repository."""
+    import yaml
+
     with open(filepath, "r") as file:
         automations = yaml.safe_load(file)
     return automations
 
+def get_related_deployment_ids(trigger: dict) -> list:
+    """Extract the IDs of the deployments a trigger is related to (match_related)."""
+    related = trigger.get("match_related", {})
+    related = related if isinstance(related, list) else [related]
+
+    deployment_ids = []
+    for resource in related:
+        resource_ids = resource.get("prefect.resource.id", [])
+        resource_ids = resource_ids if isinstance(resource_ids, list) else [resource_ids]
+        for resource_id in resource_ids:
+            match = re.fullmatch(r"prefect\.deployment\.([0-9a-f-]+)", resource_id)
+            if match:
+                deployment_ids.append(match.group(1))
+    return deployment_ids
+
+def build_coalesced_trigger(trigger: dict) -> dict:
+    """Turn a trigger on upstream events into a reactive trigger firing on every matching event.
+
+    Prefect triggers cannot batch events into one action, so the batching is done by the
+    downstream flow (see `apply_coalescing`).
+    """
+    return {
+        "type": "event",
+        "match": trigger.get("match", {}),
+        "match_related": trigger.get("match_related", {}),
+        "for_each": trigger.get("for_each", []),
+        "posture": "Reactive",
+        "expect": trigger.get("expect") or trigger.get("after") or [],
+        "threshold": 1,
+        "within": 0,
+    }
+
+def apply_coalescing(automation: dict) -> dict:
+    """Expand the `coalesce` option of an automation into its Prefect definition.
+
+    Every completed upstream run triggers the downstream deployment, which receives the
+    upstream deployment IDs (`upstream_deployment_ids`) and the window (`coalesce_window_seconds`).
+    The first downstream run of a batch waits for the window, then processes all the upstream
+    runs that completed meanwhile; the runs triggered during that window exit without work.
+    """
+    coalesce = automation.get("coalesce")
+    if not coalesce:
+        return automation
+
+    automation = {key: value for key, value in automation.items() if key != "coalesce"}
+    upstream_deployment_ids = get_related_deployment_ids(automation["trigger"])
+    automation["trigger"] = build_coalesced_trigger(automation["trigger"])
+    automation["actions"] = [
+        {
+            **action,
+            "parameters": {
+                **action.get("parameters", {}),
+                "upstream_deployment_ids": upstream_deployment_ids,
+                "coalesce_window_seconds": coalesce["within"],
+            },
+        }
+        if action.get("type") == "run-deployment"
+        else action
+        for action in automation.get("actions", [])
+    ]
+    return automation
+
 def fetch_automation(automation_name: str) -> dict:
     """Fetch an automation by name from the Prefect server."""
     automation_url = f"{PREFECT_API_URL}/automations/name/{automation_name}"
-    response = requests.get(automation_url, headers=HEADERS)
+    response = api_request("get", automation_url)
     if response.status_code == 200:
         return response.json()
     return None
@@ -45,7 +120,7 @@ def create_or_update_automation(automation_data: dict):
         if compare_automations(automation_data, server_automation):
             # Differences detected, update the automation
             automation_url = f"{PREFECT_API_URL}/automations/{server_automation['id']}"
-            response = requests.put(automation_url, headers=HEADERS, json=automation_data)
+            response = api_request("put", automation_url, json=automation_data)
             if response.status_code in [200, 201]:
                 print(f"Automation {automation_name} updated successfully.")
             else:
@@ -56,7 +131,7 @@ def create_or_update_automation(automation_data: dict):
     else:
         # Automation doesn't exist, create it
         automation_url = f"{PREFECT_API_URL}/automations"
-        response = requests.post(automation_url, headers=HEADERS, json=automation_data)
+        response = api_request("post", automation_url, json=automation_data)
         if response.status_code in [200, 201]:
             print(f"Automation {automation_name} created successfully.")
         else:
@@ -65,7 +140,7 @@ def create_or_update_automation(automation_data: dict):
 def delete_automation(automation_id: str):
     """Delete an automation using the Prefect REST API."""
     delete_url = f"{PREFECT_API_URL}/automations/{automation_id}"
-    response = requests.delete(delete_url, headers=HEADERS)
+    response = api_request("delete", delete_url)
     if response.status_code == 204:
         print(f"Successfully deleted automation with ID: {automation_id}")
     else:
@@ -74,7 +149,7 @@ def delete_automation(automation_id: str):
 def list_automations() -> list:
     """List all automations using the Prefect REST API."""
     list_url = f"{PREFECT_API_URL}/automations"
-    response = requests.get(list_url, headers=HEADERS)
+    response = api_request("get", list_url)
     if response.status_code == 200:
         return response.json()
     else:
@@ -91,10 +166,60 @@ def compare_and_delete_old_automations(current_automations: list, yaml_automatio
             print(f"Automation {automation['name']} is missing from YAML and will be deleted.")
             delete_automation(automation['id'])
 
+def validate_automations_config(automations_config: dict) -> list:
+    """Validate the structure of automations.yaml without contacting the server. Returns the errors found."""
+    if not isinstance(automations_config, dict) or not isinstance(automations_config.get('automations', []), list):
+        return ["The YAML file must define an 'automations' list."]
+
+    errors = []
+    automation_names = set()
+    for index, automation in enumerate(automations_config.get('automations') or []):
+        automation_name = automation.get('name') or f"#{index}"
+        for field in ['name', 'trigger', 'actions']:
+            if not automation.get(field):
+                errors.append(f"Automation '{automation_name}' is missing '{field}'.")
+        if automation.get('name') in automation_names:
+            errors.append(f"Automation '{automation_name}' is defined more than once.")
+        automation_names.add(automation.get('name'))
+
+        coalesce = automation.get('coalesce')
+        if coalesce is not None:
+            if not isinstance(coalesce, dict) or not isinstance(coalesce.get('within'), (int, float)) or coalesce['within'] <= 0:
+                errors.append(f"Automation '{automation_name}' must define a positive 'coalesce.within' (seconds).")
+            elif not get_related_deployment_ids(automation.get('trigger') or {}):
+                errors.append(f"Automation '{automation_name}' uses 'coalesce' but its trigger has no related deployment.")
+    return errors
+
+def plan_automations(filepath: str) -> dict:
+    """Compute which automations would be created, updated or deleted, without applying anything."""
+    yaml_automations = [
+        apply_coalescing(automation)
+        for automation in load_automation_file(filepath).get('automations', [])
+    ]
+
+    plan = {"create": [], "update": [], "delete": []}
+    for automation in yaml_automations:
+        server_automation = fetch_automation(automation['name'])
+        if not server_automation:
+            plan["create"].append(automation['name'])
+        elif compare_automations(automation, server_automation):
+            plan["update"].append(automation['name'])
+
+    yaml_automation_names = {automation['name'] for automation in yaml_automations}
+    plan["delete"] = [
+        automation['name']
+        for automation in list_automations()
+        if automation['name'] not in yaml_automation_names
+    ]
+    return plan
+
 def deploy_automations_from_yaml(filepath: str):
     """Deploy or update all automations from a YAML file, and delete removed automations."""
     # Load automations from YAML
-    yaml_automations = load_automation_file(filepath).get('automations', [])
+    yaml_automations = [
+        apply_coalescing(automation)
+        for automation in load_automation_file(filepath).get('automations', [])
+    ]
 
     # Deploy or update each automation from the YAML file
     for automation in yaml_automations:
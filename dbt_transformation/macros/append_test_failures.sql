@@ -0,0 +1,37 @@
+{% macro append_test_failures(results) %}
+
+    {#- store_failures tables are replaced on every run: append the failures stored by
+        this invocation to a history table, so past failures are kept.
+        A test stores its failures if its config says so or, when unset, if dbt runs
+        with --store-failures (same rule as dbt's should_store_failures). -#}
+    {%- if execute -%}
+        {%- set stored_failures = [] -%}
+        {%- for result in results if result.node.resource_type == 'test' and result.status in ('fail', 'warn') -%}
+            {%- set store_failures = result.node.config.get('store_failures') -%}
+            {%- if store_failures is none -%}
+                {%- set store_failures = flags.STORE_FAILURES -%}
+            {%- endif -%}
+            {%- if store_failures -%}
+                {%- do stored_failures.append(result) -%}
+            {%- endif -%}
+        {%- endfor -%}
+
+        {%- if stored_failures -%}
+            {%- set history_schema = target.schema ~ '_dbt_test__audit' %}
+            create schema if not exists {{ history_schema }};
+            create table if not exists {{ history_schema }}.test_failure_history (
+                invocation_id text not null,
+                test_name text not null,
+                failures bigint,
+                failing_row jsonb,
+                captured_at timestamptz not null
+            );
+            {%- for result in stored_failures %}
+            insert into {{ history_schema }}.test_failure_history
+            select '{{ invocation_id }}', '{{ result.node.name | replace("'", "''") }}', {{ result.failures }}, to_jsonb(stored_failure), now()
+            from {{ result.node.relation_name }} stored_failure;
+            {%- endfor -%}
+        {%- endif -%}
+    {%- endif -%}
+
+{% endmacro %}
@@ -0,0 +1,63 @@
+{{
+    config(
+        materialized='incremental',
+        incremental_strategy='delete+insert',
+        unique_key=['run_date', 'resource_type', 'resource_name'],
+        indexes=[
+            {'columns': ['run_date']},
+            {'columns': ['resource_name', 'run_date']},
+            {'columns': ['p95_execution_time']},
+        ]
+    )
+}}
+
+-- One row per resource and run date. Postgres has no partition_by in dbt, so run_date is the
+-- incremental grain instead: each run only rebuilds the days present in the new logs.
+
+with run_logs as (
+    select
+        resource_type,
+        resource_name,
+        run_status,
+        failures,
+        execution_time,
+        cast(coalesce(execution_started_at, compilation_started_at) as timestamp) as started_at,
+        extract(epoch from cast(compilation_completed_at as timestamp) - cast(compilation_started_at as timestamp)) as compile_seconds,
+        extract(epoch from cast(execution_completed_at as timestamp) - cast(execution_started_at as timestamp)) as execute_seconds
+    from {{ source('public', 'src_dbt_run_logs') }}
+    where coalesce(execution_started_at, compilation_started_at) is not null
+),
+
+new_run_logs as (
+    select
+        *,
+        cast(started_at as date) as run_date
+    from run_logs
+    {% if is_incremental() %}
+    -- The last loaded day may have been partially loaded, so it is rebuilt
+    where started_at >= (select coalesce(max(run_date), '1970-01-01') from {{ this }})
+    {% endif %}
+)
+
+select
+    run_date,
+    resource_type,
+    resource_name,
+    count(*) as run_count,
+    count(*) filter (where run_status in ('success', 'pass')) as success_count,
+    count(*) filter (where run_status in ('error', 'fail')) as failure_count,
+    count(*) filter (where run_status = 'warn') as warning_count,
+    count(*) filter (where run_status = 'skipped') as skipped_count,
+    coalesce(sum(failures), 0) as failing_rows,
+    avg(execution_time) as avg_execution_time,
+    percentile_cont(0.5) within group (order by execution_time) as p50_execution_time,
+    percentile_cont(0.9) within group (order by execution_time) as p90_execution_time,
+    percentile_cont(0.95) within group (order by execution_time) as p95_execution_time,
+    max(execution_time) as max_execution_time,
+    avg(compile_seconds) as avg_compile_seconds,
+    avg(execute_seconds) as avg_execute_seconds,
+    sum(compile_seconds) / nullif(sum(coalesce(compile_seconds, 0) + coalesce(execute_seconds, 0)), 0) as compile_time_ratio,
+    min(started_at) as first_started_at,
+    max(started_at) as last_started_at
+from new_run_logs
+group by run_date, resource_type, resource_name
@@ -0,0 +1,10 @@
+{{ config(materialized='view') }}
+
+-- Run logs with their compiled code, which is stored once per hash in src_dbt_compiled_code
+
+select
+    run_logs.*,
+    compiled_code.compiled_code
+from {{ source('public', 'src_dbt_run_logs') }} run_logs
+left join {{ source('public', 'src_dbt_compiled_code') }} compiled_code
+    on run_logs.compiled_code_hash = compiled_code.compiled_code_hash
@@ -0,0 +1,21 @@
+{{ config(materialized='view') }}
+
+-- Day over day and 7 days rolling trends, computed on the (small) aggregated metrics
+-- rather than on the raw run logs.
+
+select
+    metrics.*,
+    lag(p50_execution_time) over resource_history as previous_p50_execution_time,
+    (p50_execution_time - lag(p50_execution_time) over resource_history)
+        / nullif(lag(p50_execution_time) over resource_history, 0) as p50_execution_time_change,
+    avg(p95_execution_time) over resource_last_7_days as rolling_7d_p95_execution_time,
+    sum(failure_count) over resource_last_7_days as rolling_7d_failure_count,
+    sum(run_count) over resource_last_7_days as rolling_7d_run_count
+from {{ ref('AGG_DBT_RUN_METRICS') }} metrics
+window
+    resource_history as (partition by resource_type, resource_name order by run_date),
+    resource_last_7_days as (
+        partition by resource_type, resource_name
+        order by run_date
+        range between interval '6 days' preceding and current row
+    )
@@ -0,0 +1,29 @@
+{% test accepted_values_sampled(model, column_name, values, quote=True, sample_limit=none) %}
+
+    {#- Same as accepted_values (one row per unexpected value), but only a sample of the
+        unexpected values is returned (and stored), the number of failures is computed
+        on all of them through n_failures. -#}
+    {{ config(fail_calc='coalesce(max(n_failures), 0)') }}
+    {%- set sample_limit = sample_limit or var('test_failure_sample_limit', 100) %}
+
+    with unexpected_values as (
+        select
+            {{ column_name }} as value_field,
+            count(*) as n_records
+        from {{ model }}
+        where {{ column_name }} not in (
+            {%- for value in values -%}
+                {% if quote %}'{{ value }}'{% else %}{{ value }}{% endif %}{{ ", " if not loop.last }}
+            {%- endfor -%}
+        )
+        group by {{ column_name }}
+    )
+
+    select
+        *,
+        (select count(*) from unexpected_values) as n_failures
+    from unexpected_values
+    order by n_records desc
+    limit {{ sample_limit }}
+
+{% endtest %}
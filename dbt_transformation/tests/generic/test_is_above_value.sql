@@ -1,8 +1,16 @@
-{% test is_above_value(model, column_name, value) %}
+{% test is_above_value(model, column_name, value, sample_limit=none) %}
+
+    {#- Only a sample of the failing rows is returned (and stored), the number of
+        failures is counted separately on the whole failing set through n_failures,
+        so the limit still stops the scan of the failing rows early. -#}
+    {{ config(fail_calc='coalesce(max(n_failures), 0)') }}
+    {%- set sample_limit = sample_limit or var('test_failure_sample_limit', 100) %}
 
     select
-        *
+        *,
+        (select count(*) from {{ model }} where {{ column_name }} > {{ value }}) as n_failures
     from {{ model }}
     where {{ column_name }} > {{ value }}
+    limit {{ sample_limit }}
  
-{% endtest %}
\ No newline at end of file
+{% endtest %}
@@ -1,50 +1,118 @@
-import requests
-import yaml
 import json
+import hashlib
 import logging
 import sys
 import os
-from requests.auth import HTTPBasicAuth
+import re
+import subprocess
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+# requests and yaml are imported where they are used, so that validating the
+# YAML files from the CLI (see sync_cli.py) does not pay for the HTTP stack.
 
 # TODO: TEST IN LOCAL (add oauth2 token) FIRST!
 
-# TODO: before deleting a flow, verify that it has no flow run running. Because subflows generate flow objects.
-# However, the issue is that deleting old subflows will also delete all sbuflow run/logs
-# Leaving users the ability to clean flows from the UI might be the best option?
+# NOTE: flows not in the YAML are garbage collected, except those with active or recent runs
+# (subflows generate flow objects, and deleting a flow also deletes its runs/logs).
+# Set GC_DRY_RUN=true to only report what would be deleted.
 # TODO: Uncomment "credentials"
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-    ],
-)
-
 logger = logging.getLogger()
 
-DEBUG_MODE = False
+DEBUG_MODE = os.getenv("DEBUG_MODE", "false").lower() == "true"
 
-if DEBUG_MODE:
-    logger.setLevel(logging.DEBUG)
-else:
-    logger.setLevel(logging.INFO)
-
-
-API_BASE_URL = "http://127.0.0.1:4200/api"
-API_SIMPLE_AUTH_USER = "prefect-analytics"
-API_SIMPLE_AUTH_PASSWORD = "1234"
+API_BASE_URL = os.getenv("PREFECT_API_URL", "http://127.0.0.1:4200/api")
+API_SIMPLE_AUTH_USER = os.getenv("PREFECT_API_AUTH_USER", "prefect-analytics")
+API_SIMPLE_AUTH_PASSWORD = os.getenv("PREFECT_API_AUTH_PASSWORD", "1234")
 HEADERS = {"Content-Type": "application/json"}
 DEFAULT_WORK_POOL_NAME = "default"
 DEFAULT_WORK_QUEUE_NAME = "default"
 PREFECT_REPOSITORY_URL = os.getenv("PREFECT_REPOSITORY_URL", "https://github.com/MartinsAlex/prefect-dbt-sandbox.git")
 PREFECT_REPOSITORY_BRANCH = os.getenv("BRANCH", "main")
 DEFAULT_WORKER_IMAGE_NAME = "3.13.0-alpine3.20"
+DEFAULT_SCHEDULE_TIMEZONE = "Europe/Zurich"
+GIT_CLONE_STEP = "prefect.deployments.steps.git_clone"
+PREBUILT_IMAGE_REPOSITORY = os.getenv("PREBUILT_IMAGE_REPOSITORY")  # e.g. registry.example.com/prefect-runtime
+# Repository of the bare tags used as deployment images (e.g. "3.13.0-alpine3.20"), as resolved by the worker
+PREBUILT_BASE_IMAGE_REPOSITORY = os.getenv("PREBUILT_BASE_IMAGE_REPOSITORY")  # e.g. docker.io/library/python
+BUILD_PREBUILT_IMAGES = os.getenv("BUILD_PREBUILT_IMAGES", "false").lower() == "true"
+API_PAGE_LIMIT = 200
+
+# Fields of the normalized deployment that PATCH /deployments/{id} (DeploymentUpdate) accepts.
+# Parameters are left out: their parameter_openapi_schema must be regenerated, which only the upsert does.
+# Other changes go through the upsert, which always recreates the schedules and their upcoming runs
+# (the server deletes them on upsert, even when no schedules are sent).
+PATCHABLE_DEPLOYMENT_FIELDS = {
+    "entrypoint",
+    "description",
+    "tags",
+    "work_pool_name",
+    "work_queue_name",
+    "schedules",
+    "job_variables",
+}
+
+GC_DRY_RUN = os.getenv("GC_DRY_RUN", "false").lower() == "true"
+GC_RECENT_RUN_HOURS = int(os.getenv("GC_RECENT_RUN_HOURS", "24"))
+GC_BATCH_SIZE = 50
+GC_MAX_WORKERS = 8
+ACTIVE_FLOW_RUN_STATE_TYPES = ["SCHEDULED", "PENDING", "RUNNING", "PAUSED", "CANCELLING"]
+
+CRON_ALIASES = {
+    "@yearly": "0 0 1 1 *",
+    "@annually": "0 0 1 1 *",
+    "@monthly": "0 0 1 * *",
+    "@weekly": "0 0 * * 0",
+    "@daily": "0 0 * * *",
+    "@midnight": "0 0 * * *",
+    "@hourly": "0 * * * *",
+}
+ISO_8601_DURATION_PATTERN = re.compile(
+    r"P(?:(?P<days>\d+(?:\.\d+)?)D)?"
+    r"(?:T(?:(?P<hours>\d+(?:\.\d+)?)H)?(?:(?P<minutes>\d+(?:\.\d+)?)M)?(?:(?P<seconds>\d+(?:\.\d+)?)S)?)?"
+)
+# str() of a timedelta, e.g. "0:10:00" or "1 day, 0:00:00"
+TIMEDELTA_STRING_PATTERN = re.compile(r"(?:(?P<days>\d+) days?, )?(?P<clock>\d+:\d{2}:\d{2}(?:\.\d+)?)")
+
+
+def configure_logging(debug=DEBUG_MODE):
+    """Configure logging to stdout."""
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        handlers=[
+            logging.StreamHandler(sys.stdout),
+        ],
+    )
+
+    if debug:
+        logger.setLevel(logging.DEBUG)
+    else:
+        logger.setLevel(logging.INFO)
+
+
+def configure_api(api_url=None, api_user=None, api_password=None):
+    """Override the API settings read from the environment."""
+    global API_BASE_URL, API_SIMPLE_AUTH_USER, API_SIMPLE_AUTH_PASSWORD
+
+    API_BASE_URL = api_url or API_BASE_URL
+    API_SIMPLE_AUTH_USER = api_user or API_SIMPLE_AUTH_USER
+    API_SIMPLE_AUTH_PASSWORD = api_password or API_SIMPLE_AUTH_PASSWORD
+
+
+def api_request(method, url, **kwargs):
+    """Send an authenticated request to the Prefect REST API."""
+    import requests
+    from requests.auth import HTTPBasicAuth
+
+    return requests.request(method, url, headers=HEADERS, auth=HTTPBasicAuth(API_SIMPLE_AUTH_USER, API_SIMPLE_AUTH_PASSWORD), **kwargs)
 
 
 def load_yaml(file_path):
     """Load the YAML configuration file."""
+    import yaml
+
     try:
         with open(file_path, "r") as file:
             return yaml.safe_load(file)
@@ -53,12 +121,27 @@ def load_yaml(file_path):
         raise
 
 
+def post_filter_paginated(url, body):
+    """
+    Retrieve every object matching a `/filter` request, page by page.
+    The server caps a single response at API_PAGE_LIMIT objects.
+    """
+    objects = []
+    offset = 0
+    while True:
+        response = api_request("post", url, json={**body, "limit": API_PAGE_LIMIT, "offset": offset})
+        response.raise_for_status()
+        page = response.json()
+        objects.extend(page)
+        if len(page) < API_PAGE_LIMIT:
+            return objects
+        offset += API_PAGE_LIMIT
+
+
 def get_all_flows():
     """Retrieve all flows from the server."""
     url = f"{API_BASE_URL}/flows/filter"
-    response = requests.post(url, headers=HEADERS, json={}, auth=HTTPBasicAuth(API_SIMPLE_AUTH_USER, API_SIMPLE_AUTH_PASSWORD))
-    response.raise_for_status()
-    flows = response.json()
+    flows = post_filter_paginated(url, {})
     logger.debug(f"Retrieved flows: {flows}")
     return {flow["name"]: flow for flow in flows}
 
@@ -66,9 +149,7 @@ def get_all_flows():
 def get_all_deployments():
     """Retrieve all deployments from the server."""
     url = f"{API_BASE_URL}/deployments/filter"
-    response = requests.post(url, headers=HEADERS, json={}, auth=HTTPBasicAuth(API_SIMPLE_AUTH_USER, API_SIMPLE_AUTH_PASSWORD))
-    response.raise_for_status()
-    deployments = response.json()
+    deployments = post_filter_paginated(url, {})
     logger.debug(f"Retrieved deployments: {json.dumps(deployments, indent=4)}")
     return {dep["name"]: dep for dep in deployments}
 
@@ -77,28 +158,195 @@ def create_or_update_flow(flow_name):
     """Ensure a flow exists on the server."""
     url = f"{API_BASE_URL}/flows/"
     logger.info(f"Creating or ensuring existence of flow: {flow_name}")
-    response = requests.post(url, headers=HEADERS, json={"name": flow_name}, auth=HTTPBasicAuth(API_SIMPLE_AUTH_USER, API_SIMPLE_AUTH_PASSWORD))
+    response = api_request("post", url, json={"name": flow_name})
     response.raise_for_status()
     flow_id = response.json()["id"]
     logger.debug(f"Flow '{flow_name}' created or retrieved with ID: {flow_id}")
     return flow_id
 
 
+@lru_cache(maxsize=None)
+def get_work_pool_base_job_template(work_pool_name):
+    """
+    Retrieve the base job template of a work pool.
+    Cached so each work pool is fetched once per synchronization.
+    """
+    url = f"{API_BASE_URL}/work_pools/{work_pool_name}"
+    response = api_request("get", url)
+    if response.status_code == 404:
+        logger.warning(
+            f"Work pool '{work_pool_name}' not found on the server. Comparing job variables without its defaults."
+        )
+        return {}
+    response.raise_for_status()
+    base_job_template = response.json().get("base_job_template") or {}
+    logger.debug(f"Retrieved base job template for work pool '{work_pool_name}': {json.dumps(base_job_template, indent=4)}")
+    return base_job_template
+
+
+def get_effective_job_variables(job_variables, work_pool_name):
+    """
+    Merge job variables with the defaults of the work pool's base job template,
+    the same way the server does, so that both sides compare on effective values.
+    """
+    base_job_template = get_work_pool_base_job_template(work_pool_name)
+    properties = base_job_template.get("variables", {}).get("properties", {})
+
+    effective_job_variables = {
+        name: definition["default"]
+        for name, definition in properties.items()
+        if definition.get("default") is not None
+    }
+    effective_job_variables.update(job_variables or {})
+
+    # Unset values fall back to the template, so they carry no information
+    return {
+        name: value
+        for name, value in effective_job_variables.items()
+        if value is not None
+    }
+
+
+def with_effective_job_variables(normalized_deployment):
+    """
+    Return a copy of a normalized deployment whose job variables are merged with
+    its work pool defaults. Only used for comparison, never sent to the server.
+    """
+    return {
+        **normalized_deployment,
+        "job_variables": get_effective_job_variables(
+            normalized_deployment.get("job_variables"),
+            normalized_deployment.get("work_pool_name"),
+        ),
+    }
+
+
 def get_flow_name_by_id(flow_id):
     """
     Retrieve the flow name using its ID.
     """
     url = f"{API_BASE_URL}/flows/{flow_id}"
-    response = requests.get(url, headers=HEADERS, auth=HTTPBasicAuth(API_SIMPLE_AUTH_USER, API_SIMPLE_AUTH_PASSWORD))
+    response = api_request("get", url)
     response.raise_for_status()
     flow_data = response.json()
     return flow_data["name"]
 
 
+def normalize_cron(cron):
+    """
+    Normalize a cron expression so that equivalent spellings compare equal.
+    Collapses whitespace, expands @-aliases and rewrites '*/1' steps to '*'.
+    """
+    cron = " ".join(str(cron).split()).lower()
+    cron = CRON_ALIASES.get(cron, cron)
+
+    fields = []
+    for field in cron.split(" "):
+        parts = ["*" if part == "*/1" else part for part in field.split(",")]
+        fields.append(",".join(parts))
+    return " ".join(fields)
+
+
+def normalize_interval(interval):
+    """
+    Convert an interval to a number of seconds.
+    Accepts seconds (YAML), ISO 8601 durations and '[D day(s), ]H:MM:SS' strings (encodings of a timedelta).
+    Raises a ValueError for any other string.
+    """
+    if isinstance(interval, str):
+        iso_match = ISO_8601_DURATION_PATTERN.fullmatch(interval.strip())
+        timedelta_match = TIMEDELTA_STRING_PATTERN.fullmatch(interval.strip())
+        if iso_match:
+            seconds = (
+                float(iso_match.group("days") or 0) * 86400
+                + float(iso_match.group("hours") or 0) * 3600
+                + float(iso_match.group("minutes") or 0) * 60
+                + float(iso_match.group("seconds") or 0)
+            )
+        elif timedelta_match:
+            seconds = 0.0
+            for part in timedelta_match.group("clock").split(":"):
+                seconds = seconds * 60 + float(part)
+            seconds += float(timedelta_match.group("days") or 0) * 86400
+        else:
+            seconds = float(interval)
+    else:
+        seconds = float(interval)
+
+    return int(seconds) if seconds.is_integer() else seconds
+
+
+@lru_cache(maxsize=None)
+def canonicalize_schedule(cron, interval, timezone, active, catchup, day_or=True, max_scheduled_runs=None):
+    """
+    Return the canonical, hashable form of a schedule.
+    `day_or` only applies to cron schedules, and defaults to True like on the server.
+    Memoized since the same schedules (YAML anchors, unchanged server state) repeat across deployments.
+    """
+    return (
+        normalize_cron(cron) if cron is not None else None,
+        normalize_interval(interval) if interval is not None else None,
+        timezone or DEFAULT_SCHEDULE_TIMEZONE,
+        bool(active),
+        bool(catchup),
+        bool(day_or) if cron is not None else None,
+        int(max_scheduled_runs) if max_scheduled_runs is not None else None,
+    )
+
+
+def build_schedule(schedule, active, catchup, max_scheduled_runs=None):
+    """
+    Build a transformed schedule dictionary from its canonical form.
+    """
+    cron, interval, timezone, active, catchup, day_or, max_scheduled_runs = canonicalize_schedule(
+        schedule.get("cron"),
+        schedule.get("interval"),
+        schedule.get("timezone"),
+        active,
+        catchup,
+        schedule.get("day_or", True),
+        max_scheduled_runs,
+    )
+    return {
+        "active": active,
+        "schedule": {
+            **({"cron": cron, "day_or": day_or} if cron is not None else {}),
+            **({"interval": interval} if interval is not None else {}),
+            "timezone": timezone,
+        },
+        "catchup": catchup,
+        **({"max_scheduled_runs": max_scheduled_runs} if max_scheduled_runs is not None else {}),
+    }
+
+
+def schedule_key(schedule):
+    """
+    Return the hashable canonical key of a transformed schedule dictionary.
+    """
+    return canonicalize_schedule(
+        schedule["schedule"].get("cron"),
+        schedule["schedule"].get("interval"),
+        schedule["schedule"].get("timezone"),
+        schedule.get("active", True),
+        schedule.get("catchup", False),
+        schedule["schedule"].get("day_or", True),
+        schedule.get("max_scheduled_runs"),
+    )
+
+
+def schedules_fingerprint(schedules):
+    """
+    Return an order-independent fingerprint of a list of transformed schedules.
+    Two deployments have the same effective schedule if and only if their fingerprints are equal.
+    """
+    return tuple(sorted((schedule_key(schedule) for schedule in schedules or []), key=str))
+
+
 def validate_and_transform_schedule_field(deployment):
     """
     Validate and transform the schedule or schedules field from the YAML or API response.
     Handles both single 'schedule' and multiple 'schedules' definitions.
+    Schedules are returned in canonical form (see `canonicalize_schedule`).
     """
     transformed_schedules = []
 
@@ -108,68 +356,33 @@ def validate_and_transform_schedule_field(deployment):
             if isinstance(schedule, dict):
 
                 if "schedule" in schedule:  # deployment from API
-                    transformed_schedule = {
-                        "active": schedule.get("active", True),
-                        "schedule": {
-                            **(
-                                {"cron": schedule["schedule"]["cron"]}
-                                if "cron" in schedule.get("schedule")
-                                else {}
-                            ),
-                            **(
-                                {"interval": schedule["schedule"]["interval"]}
-                                if "interval" in schedule.get("schedule")
-                                else {}
-                            ),
-                            "timezone": schedule["schedule"].get(
-                                "timezone", "Europe/Zurich"
-                            ),
-                        },
-                        "catchup": schedule.get("catchup", False),
-                    }
+                    transformed_schedule = build_schedule(
+                        schedule["schedule"],
+                        schedule.get("active", True),
+                        schedule.get("catchup", False),
+                        schedule.get("max_scheduled_runs"),
+                    )
                     transformed_schedules.append(transformed_schedule)
 
                 else:
 
-                    transformed_schedule = {
-                        "active": schedule.get("active", True),
-                        "schedule": {
-                            **(
-                                {"cron": schedule["cron"]} if "cron" in schedule else {}
-                            ),
-                            **(
-                                {"interval": schedule["interval"]}
-                                if "interval" in schedule
-                                else {}
-                            ),
-                            "timezone": schedule.get("timezone", "Europe/Zurich"),
-                        },
-                        "catchup": schedule.get("catchup", False),
-                    }
+                    transformed_schedule = build_schedule(
+                        schedule,
+                        schedule.get("active", True),
+                        schedule.get("catchup", False),
+                        schedule.get("max_scheduled_runs"),
+                    )
                     transformed_schedules.append(transformed_schedule)
 
     # Handle "schedule" key in the deployment (single schedule)
     elif "schedule" in deployment and isinstance(deployment["schedule"], dict):
         schedule = deployment["schedule"]
-        transformed_schedule = {
-            "active": deployment.get(
-                "is_schedule_active", True
-            ),  # Handle the `is_schedule_active` flag
-            "schedule": {
-                **(
-                    {"cron": schedule["cron"]}
-                    if schedule.get("cron") is not None
-                    else {}
-                ),
-                **(
-                    {"interval": schedule["interval"]}
-                    if schedule.get("interval") is not None
-                    else {}
-                ),
-                "timezone": schedule.get("timezone", "Europe/Zurich"),
-            },
-            "catchup": schedule.get("catchup", False),
-        }
+        transformed_schedule = build_schedule(
+            schedule,
+            deployment.get("is_schedule_active", True),  # Handle the `is_schedule_active` flag
+            schedule.get("catchup", False),
+            schedule.get("max_scheduled_runs"),
+        )
         transformed_schedules.append(transformed_schedule)
 
     return transformed_schedules
@@ -236,7 +449,7 @@ def normalize_deployment_for_comparison(deployment, flow_name=None):
             "pull_steps",
             [
                 {
-                    "prefect.deployments.steps.git_clone": {
+                    GIT_CLONE_STEP: {
                         "repository": PREFECT_REPOSITORY_URL,
                         "branch": PREFECT_REPOSITORY_BRANCH,
                         #"credentials": "{{ prefect.blocks.bitbucket-credentials.my-bitbucket-credentials-block}}"
@@ -258,7 +471,10 @@ def compare_deployments(existing, new):
     changes = {}
     for key, new_value in new.items():
         existing_value = existing.get(key)
-        if isinstance(new_value, list):  # For lists, compare sorted versions
+        if key == "schedules":  # For schedules, compare canonical fingerprints
+            if schedules_fingerprint(existing_value) != schedules_fingerprint(new_value):
+                changes[key] = {"existing": existing_value, "new": new_value}
+        elif isinstance(new_value, list):  # For lists, compare sorted versions
             if sorted(existing_value or [], key=str) != sorted(new_value, key=str):
                 changes[key] = {"existing": existing_value, "new": new_value}
         elif isinstance(new_value, dict):  # For dictionaries, compare recursively
@@ -275,6 +491,8 @@ def create_or_update_deployment(normalized_deployment, flow_id):
     """
     Create or update a deployment with the Prefect REST API using normalized deployment data.
     """
+    import requests
+
     normalized_deployment.pop("flow_name")
 
     # Generate parameter_openapi_schema if parameters are present and not already defined
@@ -295,7 +513,7 @@ def create_or_update_deployment(normalized_deployment, flow_id):
 
         url = f"{API_BASE_URL}/deployments/"
 
-        response = requests.post(url, headers=HEADERS, json=normalized_deployment, auth=HTTPBasicAuth(API_SIMPLE_AUTH_USER, API_SIMPLE_AUTH_PASSWORD))
+        response = api_request("post", url, json=normalized_deployment)
 
         if response.status_code == 422:
             logger.error("Validation error when creating/updating deployment.")
@@ -303,7 +521,6 @@ def create_or_update_deployment(normalized_deployment, flow_id):
                 f"Deployment data: {json.dumps(normalized_deployment, indent=2)}"
             )
             logger.error(f"Error details: {response.json()}")
-            return
 
         response.raise_for_status()
         logger.info(f"Deployment '{normalized_deployment['name']}' created or updated.")
@@ -317,22 +534,194 @@ def create_or_update_deployment(normalized_deployment, flow_id):
         raise
 
 
+def update_deployment(deployment_id, normalized_deployment, changes):
+    """
+    Partially update an existing deployment with only the changed fields.
+    Schedules are only sent when they changed, so the server keeps the deployment's
+    upcoming scheduled runs instead of regenerating them.
+    Only fields in PATCHABLE_DEPLOYMENT_FIELDS can be updated this way.
+    """
+    import requests
+
+    deployment_name = normalized_deployment["name"]
+    update_data = {key: normalized_deployment[key] for key in changes}
+
+    url = f"{API_BASE_URL}/deployments/{deployment_id}"
+    try:
+        response = api_request("patch", url, json=update_data)
+
+        if response.status_code == 422:
+            logger.error("Validation error when updating deployment.")
+            logger.error(f"Deployment data: {json.dumps(update_data, indent=2)}")
+            logger.error(f"Error details: {response.json()}")
+
+        response.raise_for_status()
+        logger.info(f"Deployment '{deployment_name}' updated ({', '.join(sorted(update_data))}).")
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Failed to update deployment '{deployment_name}': {e}")
+        raise
+
+
 def delete_deployment(deployment_id, deployment_name):
     """Delete a deployment."""
     url = f"{API_BASE_URL}/deployments/{deployment_id}"
     logger.info(f"Deleting deployment '{deployment_name}' with ID: {deployment_id}")
-    response = requests.delete(url, headers=HEADERS, auth=HTTPBasicAuth(API_SIMPLE_AUTH_USER, API_SIMPLE_AUTH_PASSWORD))
+    response = api_request("delete", url)
     response.raise_for_status()
     logger.debug(f"Deployment '{deployment_name}' deleted successfully.")
 
 
-def synchronize_deployments(yaml_file):
+def compute_image_fingerprint(base_image, pip_packages):
     """
-    Synchronize deployments and flows between the YAML file and the server.
+    Fingerprint of a runtime image: its base image and the sorted pip requirements installed on top.
+    """
+    spec = json.dumps({"base_image": base_image, "pip_packages": sorted(pip_packages)}, sort_keys=True)
+    return hashlib.sha256(spec.encode("utf-8")).hexdigest()[:16]
+
+
+def qualify_base_image(image):
+    """
+    Fully qualified reference of a deployment image, to build a prebuilt image on top of it.
+    Bare tags are resolved against PREBUILT_BASE_IMAGE_REPOSITORY.
+    """
+    if any(separator in image for separator in ("/", ":", "@")):
+        return image
+    if not PREBUILT_BASE_IMAGE_REPOSITORY:
+        raise ValueError(
+            f"Image '{image}' is a bare tag: set PREBUILT_BASE_IMAGE_REPOSITORY to build prebuilt images on top of it."
+        )
+    return f"{PREBUILT_BASE_IMAGE_REPOSITORY}:{image}"
+
+
+def use_prebuilt_image(normalized_deployment):
+    """
+    Replace the EXTRA_PIP_PACKAGES installed at each flow run startup by a prebuilt image
+    keyed by the dependency fingerprint. Returns the deployment and the spec of the image
+    it needs, or None when it has no extra packages or no PREBUILT_IMAGE_REPOSITORY is set.
+    """
+    job_variables = normalized_deployment.get("job_variables") or {}
+    env = job_variables.get("env") or {}
+    pip_packages = env.get("EXTRA_PIP_PACKAGES", "").split()
+    if not pip_packages or not PREBUILT_IMAGE_REPOSITORY:
+        return normalized_deployment, None
+
+    base_image = qualify_base_image(job_variables.get("image", DEFAULT_WORKER_IMAGE_NAME))
+    fingerprint = compute_image_fingerprint(base_image, pip_packages)
+    image = f"{PREBUILT_IMAGE_REPOSITORY}:{fingerprint}"
+
+    prebuilt_env = {name: value for name, value in env.items() if name != "EXTRA_PIP_PACKAGES"}
+    prebuilt_job_variables = {**job_variables, "image": image, "env": prebuilt_env}
+    if not prebuilt_env:
+        prebuilt_job_variables.pop("env")
+
+    image_spec = {"image": image, "base_image": base_image, "pip_packages": sorted(pip_packages)}
+    return {**normalized_deployment, "job_variables": prebuilt_job_variables}, image_spec
+
+
+def ensure_prebuilt_image(image_spec, build_images=BUILD_PREBUILT_IMAGES):
+    """
+    Make sure a prebuilt image exists in the registry, building and pushing it if
+    `build_images` is enabled. Raises a RuntimeError if the image is not available.
+    """
+    image = image_spec["image"]
+    try:
+        inspect = subprocess.run(["docker", "manifest", "inspect", image], capture_output=True)
+    except OSError as e:
+        raise RuntimeError(f"Could not check prebuilt image '{image}': {e}") from e
+    if inspect.returncode == 0:
+        logger.debug(f"Prebuilt image '{image}' already exists.")
+        return
+
+    if not build_images:
+        raise RuntimeError(f"Prebuilt image '{image}' not found and building images is disabled.")
+
+    dockerfile = (
+        f"FROM {image_spec['base_image']}\n"
+        f"RUN pip install --no-cache-dir {' '.join(image_spec['pip_packages'])}\n"
+    )
+    logger.info(f"Building prebuilt image '{image}' ({', '.join(image_spec['pip_packages'])})...")
+    try:
+        subprocess.run(["docker", "build", "-t", image, "-"], input=dockerfile.encode("utf-8"), check=True)
+        subprocess.run(["docker", "push", image], check=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise RuntimeError(f"Failed to build prebuilt image '{image}': {e}") from e
+
+
+def prepare_deployments_runtime(normalized_deployments, check_images=False, build_images=BUILD_PREBUILT_IMAGES):
+    """
+    Speed up flow run startup of the normalized YAML deployments by using prebuilt images
+    instead of installing EXTRA_PIP_PACKAGES, whenever PREBUILT_IMAGE_REPOSITORY is set.
+    The result only depends on the YAML file, so that plans are the same on every host.
+    With `check_images`, the images must exist (or be built) before anything is applied.
+    """
+    prepared_deployments = {}
+    image_specs = {}
+    for deployment_name, normalized_deployment in normalized_deployments.items():
+        prepared_deployments[deployment_name], image_spec = use_prebuilt_image(normalized_deployment)
+        if image_spec:
+            image_specs[image_spec["image"]] = image_spec
+
+    # Several deployments sharing the same dependencies share one image
+    if check_images:
+        for image_spec in image_specs.values():
+            ensure_prebuilt_image(image_spec, build_images)
+
+    return prepared_deployments
+
+
+def validate_deployments_config(yaml_data):
+    """
+    Validate the structure of the deployments YAML without contacting the server.
+    Returns the list of errors found (empty if the configuration is valid).
+    """
+    if not isinstance(yaml_data, dict) or not isinstance(yaml_data.get("deployments"), list):
+        return ["The YAML file must define a 'deployments' list."]
+
+    errors = []
+    deployment_names = set()
+    for index, deployment in enumerate(yaml_data["deployments"]):
+        if not isinstance(deployment, dict):
+            errors.append(f"Deployment #{index} must be a mapping.")
+            continue
+
+        deployment_name = deployment.get("name") or f"#{index}"
+        for field in ("name", "flow_name", "entrypoint"):
+            if not deployment.get(field):
+                errors.append(f"Deployment '{deployment_name}' is missing '{field}'.")
+
+        if deployment.get("name") in deployment_names:
+            errors.append(f"Deployment '{deployment_name}' is defined more than once.")
+        deployment_names.add(deployment.get("name"))
+
+        entrypoint = deployment.get("entrypoint")
+        if entrypoint and not re.fullmatch(r"[^:]+\.py:\w+", entrypoint):
+            errors.append(f"Deployment '{deployment_name}' has an invalid entrypoint '{entrypoint}' (expected 'path/to/file.py:flow').")
+
+        try:
+            for schedule in validate_and_transform_schedule_field(deployment):
+                if not {"cron", "interval"} & schedule["schedule"].keys():
+                    errors.append(f"Deployment '{deployment_name}' has a schedule without 'cron' or 'interval'.")
+        except (TypeError, ValueError) as e:
+            errors.append(f"Deployment '{deployment_name}' has an invalid schedule: {e}")
+
+        job_variables = deployment.get("job_variables") or {}
+        if PREBUILT_IMAGE_REPOSITORY and (job_variables.get("env") or {}).get("EXTRA_PIP_PACKAGES"):
+            try:
+                qualify_base_image(job_variables.get("image", DEFAULT_WORKER_IMAGE_NAME))
+            except ValueError as e:
+                errors.append(f"Deployment '{deployment_name}' cannot use a prebuilt image: {e}")
+
+    return errors
+
+
+def plan_deployments(yaml_file, check_images=False, build_images=False):
+    """
+    Compute the changes needed to synchronize the server with the YAML file, without applying them.
+    Prebuilt images are only checked (and built) with `check_images`, before applying a plan.
     """
     yaml_data = load_yaml(yaml_file)
+    get_work_pool_base_job_template.cache_clear()
     yaml_deployments = {dep["name"]: dep for dep in yaml_data["deployments"]}
-    yaml_flows = {dep["flow_name"] for dep in yaml_data["deployments"]}
 
     server_flows = get_all_flows()
     server_deployments_raw = get_all_deployments()
@@ -341,14 +730,86 @@ def synchronize_deployments(yaml_file):
     # Enrich server deployments with flow names
     for dep_name, deployment in server_deployments_raw.items():
         flow_name = get_flow_name_by_id(deployment["flow_id"])
-        normalized_deployment = normalize_deployment_for_comparison(
-            deployment, flow_name
-        )
+        try:
+            normalized_deployment = normalize_deployment_for_comparison(
+                deployment, flow_name
+            )
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"Server deployment '{dep_name}' has a schedule that cannot be compared: {e}") from e
         server_deployments[dep_name] = normalized_deployment
 
+    # Normalize YAML deployments, and prepare their runtime (prebuilt images)
+    normalized_yaml_deployments = prepare_deployments_runtime(
+        {
+            deployment_name: normalize_deployment_for_comparison(deployment)
+            for deployment_name, deployment in yaml_deployments.items()
+        },
+        check_images=check_images,
+        build_images=build_images,
+    )
+
+    plan = {
+        "yaml_flows": {dep["flow_name"] for dep in yaml_data["deployments"]},
+        "server_flows": server_flows,
+        "deployments": normalized_yaml_deployments,
+        "create": [],
+        "update": {},
+        "delete": {},
+    }
+
+    for deployment_name, normalized_yaml_deployment in normalized_yaml_deployments.items():
+        if deployment_name in server_deployments:
+            changes = compare_deployments(
+                with_effective_job_variables(server_deployments[deployment_name]),
+                with_effective_job_variables(normalized_yaml_deployment),
+            )
+            if changes:
+                plan["update"][deployment_name] = {
+                    "id": server_deployments_raw[deployment_name]["id"],
+                    "changes": changes,
+                }
+        else:
+            plan["create"].append(deployment_name)
+
+    # Server deployments not in the YAML file
+    for deployment_name, server_deployment in server_deployments_raw.items():
+        if deployment_name not in yaml_deployments:
+            plan["delete"][deployment_name] = server_deployment["id"]
+
+    return plan
+
+
+def log_deployments_plan(plan):
+    """Log a summary of a deployments plan."""
+    for deployment_name in plan["create"]:
+        logger.info(f"+ Deployment '{deployment_name}' will be created.")
+    for deployment_name, update in plan["update"].items():
+        logger.info(f"~ Deployment '{deployment_name}' will be updated: {json.dumps(update['changes'], indent=4)}")
+        if not update["changes"].keys() <= PATCHABLE_DEPLOYMENT_FIELDS:
+            logger.info(f"  Deployment '{deployment_name}' will be upserted: its upcoming scheduled runs will be regenerated.")
+    for deployment_name in plan["delete"]:
+        logger.info(f"- Deployment '{deployment_name}' will be deleted.")
+    for flow_name in sorted(set(plan["yaml_flows"]) - set(plan["server_flows"])):
+        logger.info(f"+ Flow '{flow_name}' will be created.")
+    logger.info(
+        f"Plan: {len(plan['create'])} to create, {len(plan['update'])} to update, "
+        f"{len(plan['delete'])} to delete, "
+        f"{len(plan['deployments']) - len(plan['create']) - len(plan['update'])} up-to-date."
+    )
+
+
+def apply_deployments_plan(plan):
+    """
+    Apply a plan computed by `plan_deployments`: ensure flows exist, then create,
+    update and delete deployments.
+    Updates outside PATCHABLE_DEPLOYMENT_FIELDS regenerate the deployment's upcoming
+    scheduled runs, even if its schedules did not change.
+    """
+    server_flows = plan["server_flows"]
+
     # Synchronize flows and deployments
-    for deployment_name, deployment in yaml_deployments.items():
-        flow_name = deployment["flow_name"]
+    for deployment_name, normalized_yaml_deployment in plan["deployments"].items():
+        flow_name = normalized_yaml_deployment["flow_name"]
 
         # Ensure the flow exists
         if flow_name not in server_flows:
@@ -359,43 +820,144 @@ def synchronize_deployments(yaml_file):
             logger.info(f"Flow '{flow_name}' exists. Using it...")
             flow_id = server_flows[flow_name]["id"]
 
-        # Normalize YAML deployment
-        normalized_yaml_deployment = normalize_deployment_for_comparison(deployment)
-
-        # Compare and update/create deployment
-        if deployment_name in server_deployments:
-            changes = compare_deployments(
-                server_deployments[deployment_name], normalized_yaml_deployment
+        # Update/create deployment
+        if deployment_name in plan["update"]:
+            changes = plan["update"][deployment_name]["changes"]
+            logger.info(
+                f"Updating deployment '{deployment_name}' with changes: {json.dumps(changes, indent=4)}"
             )
-            if changes:
-                logger.info(
-                    f"Updating deployment '{deployment_name}' with changes: {json.dumps(changes, indent=4)}"
-                )
+            if not changes.keys() <= PATCHABLE_DEPLOYMENT_FIELDS:
+                # Fields the PATCH endpoint does not accept (flow, pull steps, ...) require a full upsert
+                if "schedules" not in changes and normalized_yaml_deployment["schedules"]:
+                    logger.warning(
+                        f"Deployment '{deployment_name}' is upserted: its upcoming scheduled runs are regenerated."
+                    )
                 create_or_update_deployment(normalized_yaml_deployment, flow_id)
             else:
-                logger.info(f"Deployment '{deployment_name}' is up-to-date.")
-        else:
+                update_deployment(
+                    plan["update"][deployment_name]["id"],
+                    normalized_yaml_deployment,
+                    changes,
+                )
+        elif deployment_name in plan["create"]:
             logger.info(
                 f"Creating deployment '{deployment_name}' for flow '{flow_name}'..."
             )
             create_or_update_deployment(normalized_yaml_deployment, flow_id)
+        else:
+            logger.info(f"Deployment '{deployment_name}' is up-to-date.")
 
     # Remove server deployments not in the YAML file
-    for deployment_name, server_deployment in server_deployments_raw.items():
-        if deployment_name not in yaml_deployments:
-            delete_deployment(server_deployment["id"], deployment_name)
+    for deployment_name, deployment_id in plan["delete"].items():
+        delete_deployment(deployment_id, deployment_name)
+
+
+def synchronize_deployments(yaml_file, gc_dry_run=GC_DRY_RUN):
+    """
+    Synchronize deployments and flows between the YAML file and the server.
+    """
+    plan = plan_deployments(yaml_file, check_images=True, build_images=BUILD_PREBUILT_IMAGES)
+    apply_deployments_plan(plan)
+
+    # Delete flows not in the YAML file, unless they have active or recent runs
+    garbage_collect_flows(plan["server_flows"], plan["yaml_flows"], dry_run=gc_dry_run)
+
+
+def get_protected_flow_ids(flow_ids):
+    """
+    Return the IDs of the flows that have an active run, or a run started within
+    the last GC_RECENT_RUN_HOURS hours.
+    The flow runs are aggregated server-side, so this is a single query returning
+    at most one object per flow, whatever the number of runs.
+    """
+    if not flow_ids:
+        return set()
+
+    recent_cutoff = datetime.now(timezone.utc) - timedelta(hours=GC_RECENT_RUN_HOURS)
+    body = {
+        "flows": {"id": {"any_": list(flow_ids)}},
+        "flow_runs": {
+            "operator": "or_",
+            "state": {"type": {"any_": ACTIVE_FLOW_RUN_STATE_TYPES}},
+            "start_time": {"after_": recent_cutoff.isoformat()},
+        },
+    }
+    url = f"{API_BASE_URL}/flows/filter"
+    protected_flows = post_filter_paginated(url, body)
+    logger.debug(f"Flows with active or recent runs: {[flow['name'] for flow in protected_flows]}")
+    return {flow["id"] for flow in protected_flows}
+
+
+def garbage_collect_flows(server_flows, yaml_flows, dry_run=GC_DRY_RUN):
+    """
+    Delete the server flows that are not referenced in the YAML file.
+    Flows with active or recent runs are protected, the others are deleted in
+    concurrent batches. The report lists the flows to delete, and those actually
+    deleted: with `dry_run`, nothing is deleted.
+    """
+    import requests
+    from concurrent.futures import ThreadPoolExecutor
+
+    orphaned_flows = {
+        flow_name: flow_details
+        for flow_name, flow_details in server_flows.items()
+        if flow_name not in yaml_flows
+    }
+    protected_flow_ids = get_protected_flow_ids(
+        [flow_details["id"] for flow_details in orphaned_flows.values()]
+    )
+
+    report = {"dry_run": dry_run, "protected": [], "to_delete": [], "deleted": [], "failed": []}
+    flows_to_delete = []
+    for flow_name, flow_details in sorted(orphaned_flows.items()):
+        if flow_details["id"] in protected_flow_ids:
+            report["protected"].append(flow_name)
+        else:
+            flows_to_delete.append((flow_details["id"], flow_name))
+            report["to_delete"].append(flow_name)
+
+    for flow_name in report["protected"]:
+        logger.info(f"Flow '{flow_name}' is not in the YAML file but has active or recent runs. Keeping it.")
+
+    if dry_run:
+        for flow_name in report["to_delete"]:
+            logger.info(f"[dry-run] Flow '{flow_name}' would be deleted.")
+        logger.info(
+            f"[dry-run] Garbage collection report: {len(report['to_delete'])} flow(s) to delete, "
+            f"{len(report['protected'])} protected."
+        )
+        return report
+
+    def delete_flow_safely(flow):
+        flow_id, flow_name = flow
+        try:
+            delete_flow(flow_id, flow_name)
+            return flow_name, None
+        except requests.exceptions.RequestException as e:
+            return flow_name, e
+
+    with ThreadPoolExecutor(max_workers=GC_MAX_WORKERS) as executor:
+        for start in range(0, len(flows_to_delete), GC_BATCH_SIZE):
+            batch = flows_to_delete[start:start + GC_BATCH_SIZE]
+            for flow_name, error in executor.map(delete_flow_safely, batch):
+                if error is None:
+                    report["deleted"].append(flow_name)
+                else:
+                    logger.error(f"Failed to delete flow '{flow_name}': {error}")
+                    report["failed"].append(flow_name)
 
-    # Delete flows not in the YAML file
-    for flow_name, flow_details in server_flows.items():
-        if flow_name not in yaml_flows:
-            delete_flow(flow_details["id"], flow_name)
+    logger.info(
+        f"Garbage collection report: {len(report['deleted'])} flow(s) deleted, "
+        f"{len(report['protected'])} protected, {len(report['failed'])} failed."
+    )
+    return report
 
 
 def delete_flow(flow_id, flow_name):
     """Delete a flow."""
     url = f"{API_BASE_URL}/flows/{flow_id}"
     logger.info(f"Deleting flow '{flow_name}' with ID: {flow_id}")
-    response = requests.delete(url, headers=HEADERS, auth=HTTPBasicAuth(API_SIMPLE_AUTH_USER, API_SIMPLE_AUTH_PASSWORD))
+    response = api_request("delete", url)
     if response.status_code == 404:
         logger.warning(
             f"Flow '{flow_name}' not found on the server. It may have been already deleted."
@@ -409,4 +971,5 @@ if __name__ == "__main__":
 
     yaml_file_path = "deployments.yml"
 
+    configure_logging()
     synchronize_deployments(yaml_file_path)
@@ -1,18 +1,120 @@
 import psycopg2
+import argparse
+import hashlib
 import json
+import os
 
-# Function to insert rows into the database
-def insert_rows_into_db(rows):
+RUN_RESULTS_PATH = "dbt_transformation/target/run_results.json"
+
+# Columns of SRC_DBT_RUN_LOGS, in insertion order
+RUN_LOG_COLUMNS = [
+    'resource_type',
+    'resource_name',
+    'run_status',
+    'resource_compiled',
+    'compiled_code_hash',
+    'compilation_started_at',
+    'compilation_completed_at',
+    'execution_started_at',
+    'execution_completed_at',
+    'execution_time',
+    'failures',
+]
+
+
+# Function to hash compiled code, used as its key in SRC_DBT_COMPILED_CODE
+def hash_compiled_code(compiled_code):
+    if not compiled_code:
+        return None
+    return hashlib.sha256(compiled_code.encode('utf-8')).hexdigest()
+
+
+# Function to connect to the database
+def connect_to_db():
     # Connect to your postgres DB
-    conn = psycopg2.connect(
+    return psycopg2.connect(
         dbname="mydatabase",  # replace with your database name
         user="admin",       # replace with your username
         password="adminpassword", # replace with your password
         host="127.0.0.1",       # replace with your host
         port=5432        # replace with your port
     )
+
+
+# Function to migrate the database to the compiled code storage by hash, run once with --migrate:
+# creates SRC_DBT_COMPILED_CODE and SRC_DBT_RUN_LOGS.compiled_code_hash, moves the compiled code of the
+# existing rows to SRC_DBT_COMPILED_CODE, then drops SRC_DBT_RUN_LOGS.compiled_code.
+# Readers of the compiled code use the VIZ_DBT_RUN_LOGS dbt view, which joins it back.
+def migrate_db():
+    conn = connect_to_db()
+    cursor = conn.cursor()
+
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS SRC_DBT_COMPILED_CODE (
+        compiled_code_hash CHAR(64) PRIMARY KEY,
+        compiled_code TEXT NOT NULL
+    )
+    """)
+    cursor.execute("ALTER TABLE SRC_DBT_RUN_LOGS ADD COLUMN IF NOT EXISTS compiled_code_hash CHAR(64)")
+
+    cursor.execute("""
+    SELECT 1 FROM information_schema.columns
+    WHERE table_name = 'src_dbt_run_logs' AND column_name = 'compiled_code'
+    """)
+    if cursor.fetchone():
+        # Same hash as hash_compiled_code: hex SHA-256 of the UTF-8 code, none for empty code
+        cursor.execute("""
+        UPDATE SRC_DBT_RUN_LOGS
+        SET compiled_code_hash = encode(sha256(convert_to(compiled_code, 'UTF8')), 'hex')
+        WHERE compiled_code_hash IS NULL AND compiled_code <> ''
+        """)
+        cursor.execute("""
+        INSERT INTO SRC_DBT_COMPILED_CODE (compiled_code_hash, compiled_code)
+        SELECT DISTINCT ON (compiled_code_hash) compiled_code_hash, compiled_code
+        FROM SRC_DBT_RUN_LOGS
+        WHERE compiled_code_hash IS NOT NULL AND compiled_code <> ''
+        ON CONFLICT (compiled_code_hash) DO NOTHING
+        """)
+        cursor.execute("ALTER TABLE SRC_DBT_RUN_LOGS DROP COLUMN compiled_code")
+
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+
+# Function to store compiled code once per hash, skipping the code already stored
+def insert_compiled_code_into_db(cursor, compiled_codes):
+    if not compiled_codes:
+        return
+
+    cursor.execute(
+        "SELECT compiled_code_hash FROM SRC_DBT_COMPILED_CODE WHERE compiled_code_hash = ANY(%s)",
+        (list(compiled_codes),)
+    )
+    existing_hashes = {row[0] for row in cursor.fetchall()}
+
+    new_compiled_codes = [
+        (compiled_code_hash, compiled_code)
+        for compiled_code_hash, compiled_code in compiled_codes.items()
+        if compiled_code_hash not in existing_hashes
+    ]
+
+    # ON CONFLICT covers concurrent loads inserting the same code
+    cursor.executemany("""
+    INSERT INTO SRC_DBT_COMPILED_CODE (compiled_code_hash, compiled_code)
+    VALUES (%s, %s)
+    ON CONFLICT (compiled_code_hash) DO NOTHING
+    """, new_compiled_codes)
+
+
+# Function to insert rows into the database
+def insert_rows_into_db(rows, compiled_codes):
+    conn = connect_to_db()
     cursor = conn.cursor()
 
+    # Store the compiled code first, run logs only reference it by hash (tables created by --migrate)
+    insert_compiled_code_into_db(cursor, compiled_codes)
+
     # SQL query to insert data
     insert_query = """
     INSERT INTO SRC_DBT_RUN_LOGS (
@@ -20,7 +122,7 @@ def insert_rows_into_db(rows):
         resource_name,
         run_status,
         resource_compiled,
-        compiled_code,
+        compiled_code_hash,
         compilation_started_at,
         compilation_completed_at,
         execution_started_at,
@@ -41,10 +143,11 @@ def insert_rows_into_db(rows):
 
 # Function to process results from the JSON file and prepare data for insertion
 def run_results_json():
-    with open("dbt_transformation/target/run_results.json", mode="r") as f:
+    with open(RUN_RESULTS_PATH, mode="r") as f:
         data = json.loads(f.read())['results']
     
     rows_to_insert = []
+    compiled_codes = {}  # Compiled code by hash, deduplicated within the run
     
     for result in data:
         resource_type = result['unique_id'].split('.')[0]  # Assuming the resource_type is the first part of the unique_id
@@ -57,6 +160,9 @@ def run_results_json():
         run_status = result['status']
         resource_compiled = result['compiled']
         compiled_code = result.get('compiled_code', '')
+        compiled_code_hash = hash_compiled_code(compiled_code)
+        if compiled_code_hash:
+            compiled_codes[compiled_code_hash] = compiled_code
 
         # Extracting timing information
         compile_timing = next((t for t in result['timing'] if t['name'] == 'compile'), {})
@@ -78,7 +184,7 @@ def run_results_json():
             resource_name,
             run_status,
             resource_compiled,
-            compiled_code,
+            compiled_code_hash,
             compilation_started_at,
             compilation_completed_at,
             execution_started_at,
@@ -90,11 +196,106 @@ def run_results_json():
         rows_to_insert.append(row)
 
     # Insert the prepared rows into the database
-    insert_rows_into_db(rows_to_insert)
+    insert_rows_into_db(rows_to_insert, compiled_codes)
+
+
+# Function to load the results from the JSON file into a columnar frame, with the same
+# columns as SRC_DBT_RUN_LOGS (plus compiled_code and the run metadata), using vectorized ops
+def run_results_dataframe(path=None):
+    import pandas as pd
+
+    with open(path or RUN_RESULTS_PATH, mode="r") as f:
+        run_results = json.load(f)
+    results = pd.DataFrame(run_results['results'])
+    metadata = run_results.get('metadata', {})
+
+    # An invocation selecting nothing has no results (and no columns to derive anything from)
+    if results.empty:
+        return pd.DataFrame(columns=['invocation_id', 'generated_at', 'compiled_code'] + RUN_LOG_COLUMNS)
+
+    # resource_type is the first part of the unique_id, resource_name the last one (the one before for tests)
+    unique_id_parts = results['unique_id'].str.split('.')
+    resource_type = unique_id_parts.str[0]
+    resource_name = unique_id_parts.str[-2].where(resource_type == 'test', unique_id_parts.str[-1])
+
+    # One row per (result, timing step), pivoted to one column per step and bound
+    timing = results['timing'].explode().dropna()
+    timing = pd.DataFrame(timing.tolist(), index=timing.index, columns=['name', 'started_at', 'completed_at'])
+    timing = timing.set_index('name', append=True)
+    timing = timing[~timing.index.duplicated()].unstack('name')
+    timing = timing.reindex(
+        index=results.index,
+        columns=pd.MultiIndex.from_product([['started_at', 'completed_at'], ['compile', 'execute']]),
+    )
+
+    compiled_code = results['compiled_code'].fillna('') if 'compiled_code' in results else pd.Series('', index=results.index)
+
+    return pd.DataFrame({
+        'invocation_id': metadata.get('invocation_id'),
+        'generated_at': pd.to_datetime(metadata.get('generated_at'), utc=True),
+        'resource_type': resource_type,
+        'resource_name': resource_name,
+        'run_status': results['status'],
+        'resource_compiled': results['compiled'],
+        'compiled_code': compiled_code,
+        'compiled_code_hash': compiled_code.map(hash_compiled_code),
+        'compilation_started_at': timing[('started_at', 'compile')],
+        'compilation_completed_at': timing[('completed_at', 'compile')],
+        'execution_started_at': timing[('started_at', 'execute')],
+        'execution_completed_at': timing[('completed_at', 'execute')],
+        'execution_time': results['execution_time'],
+        'failures': (results['failures'] if 'failures' in results else pd.Series(0, index=results.index)).astype('Int64'),
+    })
+
+
+# Function to write a Parquet snapshot of the results, partitioned by run date so that
+# the history can be read back (pd.read_parquet(parquet_dir)) without hitting the database
+def write_parquet_snapshot(df, parquet_dir):
+    run_date = df['generated_at'].iloc[0].date() if len(df) else 'unknown'
+    partition_dir = os.path.join(parquet_dir, f"run_date={run_date}")
+    os.makedirs(partition_dir, exist_ok=True)
+
+    snapshot_path = os.path.join(partition_dir, f"{df['invocation_id'].iloc[0] if len(df) else 'empty'}.parquet")
+    timestamp_columns = ['compilation_started_at', 'compilation_completed_at', 'execution_started_at', 'execution_completed_at']
+    snapshot = df.drop(columns=['compiled_code'])  # Compiled code is stored once per hash in the database
+    snapshot[timestamp_columns] = snapshot[timestamp_columns].apply(lambda column: column.astype('datetime64[ns, UTC]'))
+    snapshot.to_parquet(snapshot_path, index=False)
+    return snapshot_path
+
+
+# Function to process results with pandas: optional Parquet snapshot, then load into the database
+def run_results_pandas(parquet_dir=None, load_into_db=True):
+    df = run_results_dataframe()
+    if df.empty:
+        return
+
+    if parquet_dir:
+        write_parquet_snapshot(df, parquet_dir)
+
+    if load_into_db:
+        compiled_codes = df.loc[df['compiled_code_hash'].notna(), ['compiled_code_hash', 'compiled_code']].drop_duplicates('compiled_code_hash')
+        rows = df[RUN_LOG_COLUMNS].astype(object)
+        rows = rows.where(rows.notna(), None)
+        insert_rows_into_db(
+            list(rows.itertuples(index=False, name=None)),
+            dict(zip(compiled_codes['compiled_code_hash'], compiled_codes['compiled_code'])),
+        )
 
 
 def main():
-    run_results_json()
+    parser = argparse.ArgumentParser(description="Load dbt run results into SRC_DBT_RUN_LOGS.")
+    parser.add_argument("--migrate", action="store_true", help="Migrate the database to the compiled code storage by hash, then exit.")
+    parser.add_argument("--pandas", action="store_true", help="Transform the results with pandas instead of plain Python.")
+    parser.add_argument("--parquet-dir", help="Also write a Parquet snapshot of the results in this directory (implies --pandas).")
+    parser.add_argument("--no-db", action="store_true", help="Do not load the results into the database (with --parquet-dir).")
+    args = parser.parse_args()
+
+    if args.migrate:
+        migrate_db()
+    elif args.pandas or args.parquet_dir:
+        run_results_pandas(parquet_dir=args.parquet_dir, load_into_db=not args.no_db)
+    else:
+        run_results_json()
 
 
 if __name__ == '__main__':
@@ -1,13 +1,113 @@
 from prefect import flow, task, get_run_logger
+from prefect.client.orchestration import get_client
+from prefect.client.schemas.filters import (
+    FlowRunFilter,
+    FlowRunFilterDeploymentId,
+    FlowRunFilterId,
+    FlowRunFilterStartTime,
+    FlowRunFilterState,
+    FlowRunFilterStateType,
+)
+from prefect.client.schemas.objects import StateType
+from prefect.client.schemas.sorting import FlowRunSort
+from prefect.runtime import deployment, flow_run
+from datetime import datetime, timedelta, timezone
 import time
 import random
 
+UPSTREAM_RUNS_PAGE_LIMIT = 200
+
 @task
 def transform():
     time.sleep(random.randint(1,10))
 
+@task
+def get_upstream_flow_run_ids(upstream_deployment_ids: list, coalesce_window_seconds: int = 0, max_lookback_seconds: int = 86400):
+    """
+    Upstream runs of the batch this run is responsible for: the ones that completed between the end of
+    the previous batch and `coalesce_window_seconds` after this run started (waiting for them).
+    Returns None if this run started within the window of a previous run, which handles the batch.
+    """
+    window = timedelta(seconds=coalesce_window_seconds)
+    with get_client(sync_client=True) as client:
+        current_run = client.read_flow_run(flow_run.id)
+        until = current_run.start_time + window
+        since = until - timedelta(seconds=max_lookback_seconds)  # Bounds the first batch ever
+
+        if deployment.id:
+            # Replay the previous runs of the lookback period to find the batch in progress: a run
+            # handles a batch if it started after the end of the previous batch, else it is part of it.
+            # Running runs count too: they may still be waiting for their batch.
+            previous_runs = []
+            offset = 0
+            while True:
+                page = client.read_flow_runs(
+                    flow_run_filter=FlowRunFilter(
+                        id=FlowRunFilterId(not_any_=[flow_run.id]),
+                        start_time=FlowRunFilterStartTime(after_=since, before_=current_run.start_time),
+                        deployment_id=FlowRunFilterDeploymentId(any_=[deployment.id]),
+                        state=FlowRunFilterState(type=FlowRunFilterStateType(any_=[StateType.RUNNING, StateType.COMPLETED])),
+                    ),
+                    sort=FlowRunSort.START_TIME_ASC,
+                    limit=UPSTREAM_RUNS_PAGE_LIMIT,
+                    offset=offset,
+                )
+                previous_runs += page
+                if len(page) < UPSTREAM_RUNS_PAGE_LIMIT:
+                    break
+                offset += UPSTREAM_RUNS_PAGE_LIMIT
+
+            # Runs starting at the same time are ordered by ID, so exactly one of them handles the batch
+            previous_batch_until = None
+            for run in sorted(previous_runs, key=lambda run: (run.start_time, str(run.id))):
+                if (run.start_time, str(run.id)) >= (current_run.start_time, str(current_run.id)):
+                    break
+                if previous_batch_until is None or run.start_time > previous_batch_until:
+                    previous_batch_until = run.start_time + window
+
+            if previous_batch_until is not None:
+                if previous_batch_until >= current_run.start_time:
+                    return None
+                since = max(since, previous_batch_until)
+
+        # Wait for the upstream runs of the batch to complete
+        time.sleep(max((until - datetime.now(timezone.utc)).total_seconds(), 0))
+
+        # The API cannot filter on end time: page through the completed runs, latest ended first
+        upstream_runs = []
+        offset = 0
+        while True:
+            page = client.read_flow_runs(
+                flow_run_filter=FlowRunFilter(
+                    deployment_id=FlowRunFilterDeploymentId(any_=upstream_deployment_ids),
+                    state=FlowRunFilterState(type=FlowRunFilterStateType(any_=[StateType.COMPLETED])),
+                    start_time=FlowRunFilterStartTime(before_=until),
+                ),
+                sort=FlowRunSort.END_TIME_DESC,
+                limit=UPSTREAM_RUNS_PAGE_LIMIT,
+                offset=offset,
+            )
+            upstream_runs += [
+                run for run in page
+                if run.end_time and since < run.end_time <= until
+            ]
+            if len(page) < UPSTREAM_RUNS_PAGE_LIMIT or (page[-1].end_time and page[-1].end_time <= since):
+                break
+            offset += UPSTREAM_RUNS_PAGE_LIMIT
+    return [str(run.id) for run in upstream_runs]
+
 @flow
-def main():
+def main(upstream_flow_run_ids: list = None, upstream_deployment_ids: list = None, coalesce_window_seconds: int = 0):
     logger = get_run_logger()
-    logger.info("Tranforming data")
 
+    # Coalesced automations only pass the upstream deployments, the runs are resolved here
+    if upstream_flow_run_ids is None and upstream_deployment_ids:
+        upstream_flow_run_ids = get_upstream_flow_run_ids(upstream_deployment_ids, coalesce_window_seconds)
+        if upstream_flow_run_ids is None:
+            logger.info("Upstream runs are handled by the transformation run of the current batch. Nothing to do.")
+            return
+        if not upstream_flow_run_ids:
+            logger.info("No upstream run completed since the last transformation. Nothing to do.")
+            return
+
+    logger.info(f"Tranforming data of upstream runs: {upstream_flow_run_ids or 'all'}")
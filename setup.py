@@ -4,4 +4,8 @@ setup(
     name='utils',
     version='0.1',
     packages=find_packages(),
-)
\ No newline at end of file
+    py_modules=['sync_cli', 'deploy_v2', 'automations_manager'],
+    entry_points={
+        'console_scripts': ['prefect-sync=sync_cli:main'],
+    },
+)
@@ -0,0 +1,115 @@
+"""
+Command line entry point to synchronize deployments and automations with the Prefect server.
+
+    python sync_cli.py validate              # check the YAML files, no server access
+    python sync_cli.py plan                  # show what would change on the server
+    python sync_cli.py apply                 # synchronize the server with the YAML files
+    python sync_cli.py gc --dry-run          # report (or delete) orphaned flows
+
+API settings are read from the environment (PREFECT_API_URL, PREFECT_API_AUTH_USER,
+PREFECT_API_AUTH_PASSWORD, OAUTH_TOKEN) and can be overridden with flags.
+Heavy modules (requests, yaml) are only imported by the commands that need them.
+"""
+import argparse
+import os
+import sys
+
+import automations_manager
+import deploy_v2
+
+logger = deploy_v2.logger
+
+
+def validate(args):
+    """Validate the YAML files. Returns the number of errors found."""
+    errors = deploy_v2.validate_deployments_config(deploy_v2.load_yaml(args.deployments))
+    if args.automations:
+        errors += automations_manager.validate_automations_config(
+            automations_manager.load_automation_file(args.automations)
+        )
+
+    for error in errors:
+        logger.error(error)
+    if not errors:
+        logger.info("Configuration is valid.")
+    return len(errors)
+
+
+def plan(args):
+    """Log the changes that `apply` would make."""
+    if validate(args):
+        return 1
+
+    try:
+        deploy_v2.log_deployments_plan(deploy_v2.plan_deployments(args.deployments))
+    except ValueError as e:
+        logger.error(e)
+        return 1
+    if args.automations:
+        automations_plan = automations_manager.plan_automations(args.automations)
+        for action, automation_names in automations_plan.items():
+            for automation_name in automation_names:
+                logger.info(f"Automation '{automation_name}' will be {action}d.")
+    return 0
+
+
+def apply(args):
+    """Synchronize the server with the YAML files."""
+    if validate(args):
+        return 1
+
+    try:
+        deploy_v2.synchronize_deployments(args.deployments, gc_dry_run=args.gc_dry_run)
+    except ValueError as e:
+        logger.error(e)
+        return 1
+    if args.automations:
+        automations_manager.deploy_automations_from_yaml(args.automations)
+    return 0
+
+
+def gc(args):
+    """Garbage collect the flows that are not referenced in the deployments YAML file."""
+    yaml_data = deploy_v2.load_yaml(args.deployments)
+    yaml_flows = {dep["flow_name"] for dep in yaml_data["deployments"]}
+    report = deploy_v2.garbage_collect_flows(deploy_v2.get_all_flows(), yaml_flows, dry_run=args.dry_run)
+    return 1 if report["failed"] else 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--deployments", default=os.getenv("DEPLOYMENTS_FILE", "deployments.yml"), help="Deployments YAML file.")
+    parser.add_argument("--automations", default=os.getenv("AUTOMATIONS_FILE"), help="Automations YAML file (automations are skipped if not set).")
+    parser.add_argument("--api-url", help="Prefect API URL (default: $PREFECT_API_URL).")
+    parser.add_argument("--api-user", help="Basic auth user (default: $PREFECT_API_AUTH_USER).")
+    parser.add_argument("--api-password", help="Basic auth password (default: $PREFECT_API_AUTH_PASSWORD).")
+    parser.add_argument("--oauth-token", help="OAuth2 token for automations (default: $OAUTH_TOKEN).")
+    parser.add_argument("--debug", action="store_true", default=deploy_v2.DEBUG_MODE, help="Enable debug logging.")
+
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("validate", help=validate.__doc__).set_defaults(func=validate)
+    subparsers.add_parser("plan", help=plan.__doc__).set_defaults(func=plan)
+
+    apply_parser = subparsers.add_parser("apply", help=apply.__doc__)
+    apply_parser.add_argument("--gc-dry-run", action="store_true", default=deploy_v2.GC_DRY_RUN, help="Only report the flows that would be garbage collected.")
+    apply_parser.set_defaults(func=apply)
+
+    gc_parser = subparsers.add_parser("gc", help=gc.__doc__)
+    gc_parser.add_argument("--dry-run", action="store_true", default=deploy_v2.GC_DRY_RUN, help="Only report the flows that would be deleted.")
+    gc_parser.set_defaults(func=gc)
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    deploy_v2.configure_logging(args.debug)
+    deploy_v2.configure_api(args.api_url, args.api_user, args.api_password)
+    automations_manager.configure_api(args.api_url, args.oauth_token)
+
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())